@@ -0,0 +1,39 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""Compiled counterpart of `_fedex_step` in `federatedscope.autotune.fedex.server`, used when numba is not available.
+"""
+from libc.math cimport exp, log
+
+
+cpdef tuple softmax_mirror_step(double[::1] z, double[::1] grad, double eta,
+                                double[::1] theta):
+    """Perform one exponentiated gradient step on the logits `z` and write the normalized probabilities into `theta`, both in place.
+    Returns:
+        the entropy and the largest probability of the updated `theta`.
+    """
+    cdef Py_ssize_t j, n = z.shape[0]
+    cdef double m, total = 0.0, log_total, inv_total
+    cdef double entropy = 0.0, theta_max = 0.0
+
+    for j in range(n):
+        z[j] -= eta * grad[j]
+    m = z[0]
+    for j in range(1, n):
+        if z[j] > m:
+            m = z[j]
+    # z <= 0 after subtracting the max, so exp(z) is in (0, 1]
+    for j in range(n):
+        z[j] -= m
+        theta[j] = exp(z[j])
+        total += theta[j]
+    log_total = log(total)
+    inv_total = 1.0 / total
+    for j in range(n):
+        # z is log(theta) now
+        z[j] -= log_total
+        theta[j] *= inv_total
+        if theta[j] > 0.0:
+            # z[j] might be -inf otherwise
+            entropy -= z[j] * theta[j]
+        if theta[j] > theta_max:
+            theta_max = theta[j]
+    return entropy, theta_max
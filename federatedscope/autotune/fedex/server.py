@@ -1,11 +1,20 @@
 import os
 import logging
-from itertools import product
+from functools import lru_cache, reduce
+from operator import mul
 
 import yaml
 
 import numpy as np
-from scipy.special import logsumexp
+from scipy.special import xlogy
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+try:
+    from federatedscope.autotune.fedex._fedex_c import softmax_mirror_step
+except ImportError:
+    softmax_mirror_step = None
 
 from federatedscope.core.message import Message
 from federatedscope.core.worker import Server
@@ -16,11 +25,75 @@ from federatedscope.core.auxiliaries.utils import merge_dict
 logger = logging.getLogger(__name__)
 
 
-def discounted_mean(trace, factor=1.0):
+@lru_cache(maxsize=8)
+def _load_search_space(ss_path, mtime):
+    """Load the search space from `ss_path` and extract its to-be-determined hyper-parameters, which are memoized across the servers created in one process.
+    Arguments:
+        ss_path (str): the path of the search space file.
+        mtime (float): the modification time of the search space file, so that a modified file is loaded again.
+    Returns:
+        dict: the to-be-determined hyper-parameters, which should not be modified.
+    """
+    with open(ss_path, 'r') as ips:
+        ss = yaml.load(ips, Loader=yaml.FullLoader)
+    _, tbd_config = split_raw_config(ss)
+    return tbd_config
+
+
+def _fedex_step(z, grad, eta, theta):
+    """Perform one exponentiated gradient step on the logits `z` and write the normalized probabilities into `theta`, both in place.
+    Returns:
+        the entropy and the largest probability of the updated `theta`.
+    """
+    z -= eta * grad
+    # z <= 0 after subtracting the max, so exp(z) is in (0, 1]
+    z -= z.max()
+    np.exp(z, theta)
+    total = theta.sum()
+    z -= np.log(total)
+    theta *= 1.0 / total
+    # z is log(theta) now, where the arms with theta == 0 (z might be -inf)
+    # contribute nothing to the entropy
+    return -np.sum(np.where(theta > 0.0, z * theta, 0.0)), theta.max()
+
+
+def _fedex_batch_step(z, grad, eta, theta):
+    """Perform `_fedex_step` on each row of the (#dimensions, #arms) arrays `z` and `theta` at once, where `eta` holds the step size of each row.
+    Returns:
+        the entropy and the largest probability of the product of the updated distributions.
+    """
+    z -= eta[:, np.newaxis] * grad
+    z -= z.max(axis=1, keepdims=True)
+    np.exp(z, theta)
+    total = theta.sum(axis=1, keepdims=True)
+    z -= np.log(total)
+    theta *= 1.0 / total
+    # z is log(theta) now, where the arms with theta == 0 (z might be -inf)
+    # contribute nothing to the entropy
+    entropy = -np.sum(np.where(theta > 0.0, z * theta, 0.0))
+    return entropy, np.prod(theta.max(axis=1))
+
+
+def _fedex_rows_step(z, grad, eta, theta):
+    """Same as `_fedex_batch_step`, but by calling `_fedex_step` on each row.
+    """
+    entropy, mle = 0.0, 1.0
+    for i in range(z.shape[0]):
+        entropy_i, mle_i = _fedex_step(z[i], grad[i], eta[i], theta[i])
+        entropy += entropy_i
+        mle *= mle_i
+    return entropy, mle
 
-    weight = factor**np.flip(np.arange(len(trace)), axis=0)
 
-    return np.inner(trace, weight) / weight.sum()
+if njit is not None:
+    _fedex_step = njit(cache=True)(_fedex_step)
+    # numba doesn't support reductions along an axis, so the compiled
+    # batched step loops over the rows instead
+    _fedex_batch_step = njit(cache=True)(_fedex_rows_step)
+elif softmax_mirror_step is not None:
+    # the Cython extension, which is built by setup.py if Cython is available
+    _fedex_step = softmax_mirror_step
+    _fedex_batch_step = _fedex_rows_step
 
 
 class FedExServer(Server):
@@ -39,9 +112,8 @@ class FedExServer(Server):
                  **kwargs):
 
         # initialize action space and the policy
-        with open(config.hpo.fedex.ss, 'r') as ips:
-            ss = yaml.load(ips, Loader=yaml.FullLoader)
-        _, tbd_config = split_raw_config(ss)
+        tbd_config = _load_search_space(config.hpo.fedex.ss,
+                                        os.path.getmtime(config.hpo.fedex.ss))
         if config.hpo.fedex.flatten_ss:
             self._cfsp = [random_search(tbd_config, config.hpo.fedex.num_arms)]
         else:
@@ -51,57 +123,107 @@ class FedExServer(Server):
         sizes = [len(cand_set) for cand_set in self._cfsp]
         # TODO: support other step size
         eta0 = 'auto'
-        self._eta0 = [
+        self._eta0 = np.asarray([
             np.sqrt(2.0 * np.log(size)) if eta0 == 'auto' else eta0
             for size in sizes
-        ]
-        self._z = [np.full(size, -np.log(size)) for size in sizes]
-        self._theta = [np.exp(z) for z in self._z]
-        self._store = [0.0 for _ in sizes]
+        ])
+        # step size denominators of the 'scale' schedule
+        self._scale_denom = np.asarray([
+            1.0 / np.sqrt(2.0 * np.log(size)) if size > 1 else float('inf')
+            for size in sizes
+        ])
+        if len(set(sizes)) == 1:
+            # all the dimensions have the same number of arms, so that the
+            # policy is kept as (#dimensions, #arms) arrays and updated at once
+            self._z = np.full((len(sizes), sizes[0]), -np.log(sizes[0]))
+            self._theta = np.exp(self._z)
+        else:
+            self._z = [np.full(size, -np.log(size)) for size in sizes]
+            self._theta = [np.exp(z) for z in self._z]
+        self._store = np.zeros(len(sizes))
+        # running discounted sums of the global/refine traces, which give
+        # the baseline without re-weighting the whole history every round
+        self._global_wsum = 0.0
+        self._refine_wsum = 0.0
+        self._wsum_den = 0.0
+        # one entry per round (plus the initial ones of entropy and mle),
+        # allocated upfront and grown in _append_trace only if needed
         self._trace = {
-            'global': [],
-            'refine': [],
-            'entropy': [self.entropy()],
-            'mle': [self.mle()]
+            key: np.empty(total_round_num + 1, dtype=np.float64)
+            for key in ['global', 'refine', 'entropy', 'mle']
         }
+        self._trace_len = {key: 0 for key in self._trace}
+        self._append_trace('entropy', self.entropy())
+        self._append_trace('mle', self.mle())
         self._stop_exploration = False
+        self._rng = np.random.default_rng(config.seed)
 
         super(FedExServer,
               self).__init__(ID, state, config, data, model, client_num,
                              total_round_num, device, strategy, **kwargs)
 
     def entropy(self):
-
-        entropy = 0.0
-        for probs in product(*(theta[theta > 0.0] for theta in self._theta)):
-            prob = np.prod(probs)
-            entropy -= prob * np.log(prob)
-        return entropy
+        # the entropy of the product of independent categorical
+        # distributions is the sum of their individual entropies
+        return -sum(xlogy(theta, theta).sum() for theta in self._theta)
 
     def mle(self):
-
-        return np.prod([theta.max() for theta in self._theta])
+        # returns a Python float, as multiplying a handful of scalars
+        # doesn't deserve building an ndarray
+        return reduce(mul, (float(theta.max()) for theta in self._theta), 1.0)
 
     def trace(self, key):
-        '''returns trace of one of three tracked quantities
+        '''returns trace of one of four tracked quantities
         Args:
-            key (str): 'entropy', 'global', or 'refine'
+            key (str): 'entropy', 'mle', 'global', or 'refine'
         Returns:
-            numpy vector with length equal to number of rounds up to now.
+            numpy vector with length equal to number of rounds up to now, which is a read-only view of the internal buffer.
         '''
 
-        return np.array(self._trace[key])
+        trace = self._trace[key][:self._trace_len[key]]
+        trace.flags.writeable = False
+        return trace
+
+    def _append_trace(self, key, value):
+        cur = self._trace_len[key]
+        if cur == len(self._trace[key]):
+            self._trace[key] = np.resize(self._trace[key], 2 * cur + 1)
+        self._trace[key][cur] = value
+        self._trace_len[key] = cur + 1
 
     def sample(self):
         if self._stop_exploration:
-            cfg_idx = [theta.argmax() for theta in self._theta]
+            cfg_idx = [int(theta.argmax()) for theta in self._theta]
         else:
             cfg_idx = [
-                np.random.choice(len(theta), p=theta) for theta in self._theta
+                self._rng.choice(len(theta), p=theta) for theta in self._theta
             ]
         sampled_cfg = [sps[i] for i, sps in zip(cfg_idx, self._cfsp)]
         return cfg_idx, sampled_cfg
 
+    def sample_batch(self, n):
+        """Sample the configurations for `n` clients at once, where the arms of each dimension are drawn by one multinomial draw of their counts followed by a random permutation
+        Arguments:
+            n (int): the number of configurations to sample.
+        Returns:
+            cfg_idxs (list): each element is the arms of one client, i.e., the first output of `sample()`.
+            sampled_cfgs (list): each element is the configuration of one client, i.e., the second output of `sample()`.
+        """
+        if self._stop_exploration:
+            cfg_idx = [int(theta.argmax()) for theta in self._theta]
+            cfg_idxs = [list(cfg_idx) for _ in range(n)]
+        else:
+            draws = []
+            for theta in self._theta:
+                counts = self._rng.multinomial(n, theta)
+                arms = np.repeat(np.arange(len(theta)), counts)
+                self._rng.shuffle(arms)
+                draws.append(arms)
+            cfg_idxs = np.stack(draws, axis=1).tolist()
+        sampled_cfgs = [[sps[i] for i, sps in zip(cfg_idx, self._cfsp)]
+                        for cfg_idx in cfg_idxs]
+        return cfg_idxs, sampled_cfgs
+
     def broadcast_model_para(self,
                              msg_type='model_para',
                              sample_client_num=-1):
@@ -129,16 +251,17 @@ class FedExServer(Server):
             model_para = [model.state_dict() for model in self.models]
         else:
             model_para = self.model.state_dict()
+        # the model parameters are shared by reference among all the
+        # messages (they are never copied when sending in standalone mode),
+        # thus receivers must not modify them in place
+        content_base = {'model_param': model_para}
 
         # sample the hyper-parameter config specific to the clients
+        cfg_idxs, sampled_cfgs = self.sample_batch(len(receiver))
 
-        for rcv_idx in receiver:
-            cfg_idx, sampled_cfg = self.sample()
-            content = {
-                'model_param': model_para,
-                "arms": cfg_idx,
-                'hyperparam': sampled_cfg
-            }
+        for rcv_idx, cfg_idx, sampled_cfg in zip(receiver, cfg_idxs,
+                                                 sampled_cfgs):
+            content = dict(content_base, arms=cfg_idx, hyperparam=sampled_cfg)
             self.comm_manager.send(
                 Message(msg_type=msg_type,
                         sender=self.ID,
@@ -161,70 +284,104 @@ class FedExServer(Server):
             self.aggregator.inc(tuple(content[0:2]))
         self.check_and_move_on()
 
+    def _track_losses(self, global_val, refine_val):
+        self._append_trace('global', global_val)
+        self._append_trace('refine', refine_val)
+        gamma = self._cfg.hpo.fedex.gamma
+        self._global_wsum = gamma * self._global_wsum + global_val
+        self._refine_wsum = gamma * self._refine_wsum + refine_val
+        self._wsum_den = gamma * self._wsum_den + 1.0
+
+    def _step_denom(self, i, grad):
+        """Get the denominator of the step size according to the schedule
+        Arguments:
+            i (int or slice): the dimension(s) to update.
+            grad (numpy.ndarray): the gradient of these dimension(s), with the arms along the last axis.
+        """
+        if self._cfg.hpo.fedex.sched == 'adaptive':
+            # infinity norm of the gradient
+            grad_norm = np.abs(grad).max(axis=-1)
+            self._store[i] += grad_norm * grad_norm
+            return np.sqrt(self._store[i])
+        elif self._cfg.hpo.fedex.sched == 'aggressive':
+            return np.where(grad.any(axis=-1), np.abs(grad).max(axis=-1), 1.0)
+        elif self._cfg.hpo.fedex.sched == 'auto':
+            self._store[i] += 1.0
+            return np.sqrt(self._store[i])
+        elif self._cfg.hpo.fedex.sched == 'constant':
+            return 1.0
+        elif self._cfg.hpo.fedex.sched == 'scale':
+            return self._scale_denom[i]
+        else:
+            raise NotImplementedError
+
     def update_policy(self, feedbacks):
         """Update the policy. This implementation is borrowed from the open-sourced FedEx (https://github.com/mkhodak/FedEx/blob/150fac03857a3239429734d59d319da71191872e/hyper.py#L151)
         Arguments:
             feedbacks (list): each element is a tuple in the form (sample_size, arms, loss)
         """
 
-        index = [tp[1] for tp in feedbacks]
+        if self._stop_exploration:
+            # the policy is fixed, so only the traces are tracked
+            total = float(sum(tp[0] for tp in feedbacks))
+            # TODO: acquire client-wise validation loss before local updates
+            loss = sum(tp[0] * tp[2] for tp in feedbacks) / total
+            self._track_losses(loss, loss)
+            self._append_trace('entropy', 0.0)
+            self._append_trace('mle', 1.0)
+            return
+
+        index = np.asarray([tp[1] for tp in feedbacks], dtype=np.intp)
         weight = np.asarray([tp[0] for tp in feedbacks], dtype=np.float64)
         weight /= np.sum(weight)
         # TODO: acquire client-wise validation loss before local updates
-        before = np.asarray([tp[2] for tp in feedbacks])
-        after = np.asarray([tp[2] for tp in feedbacks])
+        before = after = np.fromiter((tp[2] for tp in feedbacks),
+                                     dtype=np.float64,
+                                     count=len(feedbacks))
 
-        if self._trace['refine']:
-            trace = self.trace('refine')
+        if self._wsum_den > 0.0:
+            baseline = self._refine_wsum
             if self._cfg.hpo.fedex.diff:
-                trace -= self.trace('global')
-            baseline = discounted_mean(trace, self._cfg.hpo.fedex.gamma)
+                baseline -= self._global_wsum
+            baseline /= self._wsum_den
         else:
             baseline = 0.0
-        self._trace['global'].append(np.inner(before, weight))
-        self._trace['refine'].append(np.inner(after, weight))
-        if self._stop_exploration:
-            self._trace['entropy'].append(0.0)
-            self._trace['mle'].append(1.0)
-            return
-
-        for i, (z, theta) in enumerate(zip(self._z, self._theta)):
-            grad = np.zeros(len(z))
-            for idx, s, w in zip(
-                    index,
-                    after - before if self._cfg.hpo.fedex.diff else after,
-                    weight):
-                grad[idx[i]] += w * (s - baseline) / theta[idx[i]]
-            if self._cfg.hpo.fedex.sched == 'adaptive':
-                self._store[i] += norm(grad, float('inf'))**2
-                denom = np.sqrt(self._store[i])
-            elif self._cfg.hpo.fedex.sched == 'aggressive':
-                denom = 1.0 if np.all(
-                    grad == 0.0) else norm(grad, float('inf'))
-            elif self._cfg.hpo.fedex.sched == 'auto':
-                self._store[i] += 1.0
-                denom = np.sqrt(self._store[i])
-            elif self._cfg.hpo.fedex.sched == 'constant':
-                denom = 1.0
-            elif self._cfg.hpo.fedex.sched == 'scale':
-                denom = 1.0 / np.sqrt(
-                    2.0 * np.log(len(grad))) if len(grad) > 1 else float('inf')
-            else:
-                raise NotImplementedError
-            eta = self._eta0[i] / denom
-            z -= eta * grad
-            z -= logsumexp(z)
-            self._theta[i] = np.exp(z)
-
-        self._trace['entropy'].append(self.entropy())
-        self._trace['mle'].append(self.mle())
-        if self._trace['entropy'][-1] < self._cfg.hpo.fedex.cutoff:
+        self._track_losses(np.inner(before, weight), np.inner(after, weight))
+
+        signal = after - before if self._cfg.hpo.fedex.diff else after
+        contrib = weight * (signal - baseline)
+        # the policy is a product of independent categorical distributions,
+        # so its entropy is the sum of theirs and its mle is the product
+        if isinstance(self._z, np.ndarray):
+            dims = np.arange(len(self._z))
+            grad = np.zeros_like(self._z)
+            np.add.at(grad, (dims, index),
+                      contrib[:, np.newaxis] / self._theta[dims, index])
+            eta = self._eta0 / self._step_denom(slice(None), grad)
+            entropy, mle = _fedex_batch_step(self._z, grad, eta, self._theta)
+        else:
+            entropy, mle = 0.0, 1.0
+            for i, (z, theta) in enumerate(zip(self._z, self._theta)):
+                sel = index[:, i]
+                grad = np.zeros(len(z))
+                np.add.at(grad, sel, contrib / theta[sel])
+                eta = self._eta0[i] / self._step_denom(i, grad)
+                entropy_i, mle_i = _fedex_step(z, grad, eta, theta)
+                entropy += entropy_i
+                mle *= mle_i
+
+        self._append_trace('entropy', entropy)
+        self._append_trace('mle', mle)
+        if entropy < self._cfg.hpo.fedex.cutoff:
             self._stop_exploration = True
 
-        logger.info(
-            'Server #{:d}: Updated policy as {} with entropy {:f} and mle {:f}'
-            .format(self.ID, self._theta, self._trace['entropy'][-1],
-                    self._trace['mle'][-1]))
+        if logger.isEnabledFor(logging.INFO):
+            # summarize long thetas instead of printing all the arms
+            policy = '[{}]'.format(', '.join(
+                np.array2string(theta, threshold=10) for theta in self._theta))
+            logger.info(
+                'Server #%d: Updated policy as %s with entropy %f and mle %f',
+                self.ID, policy, entropy, mle)
 
     def check_and_move_on(self, check_eval_result=False):
         """
@@ -241,30 +398,20 @@ class FedExServer(Server):
         if self.check_buffer(self.state, minimal_number, check_eval_result):
 
             if not check_eval_result:  # in the training process
-                mab_feedbacks = list()
                 # Get all the message
-                train_msg_buffer = self.msg_buffer['train'][self.state]
+                train_msgs = self.msg_buffer['train'][self.state].values()
+                # temporarily, we consider training loss
+                # TODO: use validation loss and sample size
+                mab_feedbacks = [(msg[0], msg[2], msg[3])
+                                 for msg in train_msgs]
                 for model_idx in range(self.model_num):
                     model = self.models[model_idx]
                     aggregator = self.aggregators[model_idx]
-                    msg_list = list()
-                    for client_id in train_msg_buffer:
-                        if self.model_num == 1:
-                            msg_list.append(
-                                tuple(train_msg_buffer[client_id][0:2]))
-                        else:
-                            train_data_size, model_para_multiple = train_msg_buffer[
-                                client_id][0:2]
-                            msg_list.append((train_data_size,
-                                             model_para_multiple[model_idx]))
-
-                        if model_idx == 0:
-                            # temporarily, we consider training loss
-                            # TODO: use validation loss and sample size
-                            mab_feedbacks.append(
-                                (train_msg_buffer[client_id][0],
-                                 train_msg_buffer[client_id][2],
-                                 train_msg_buffer[client_id][3]))
+                    if self.model_num == 1:
+                        msg_list = [(msg[0], msg[1]) for msg in train_msgs]
+                    else:
+                        msg_list = [(msg[0], msg[1][model_idx])
+                                    for msg in train_msgs]
 
                     # Trigger the monitor here (for training)
                     if 'dissim' in self._cfg.eval.monitoring:
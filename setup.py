@@ -7,6 +7,21 @@ import setuptools
 with open("README.md", "r") as fh:
     long_description = fh.read()
 
+try:
+    from Cython.Build import cythonize
+    # optional, so that a failed build (e.g., without a C compiler) falls
+    # back to the pure Python implementation instead of failing the install
+    ext_modules = cythonize([
+        setuptools.Extension('federatedscope.autotune.fedex._fedex_c',
+                             ['federatedscope/autotune/fedex/_fedex_c.pyx'],
+                             optional=True)
+    ])
+    # cythonize doesn't carry `optional` over to the extensions it returns
+    for ext in ext_modules:
+        ext.optional = True
+except ImportError:
+    ext_modules = []
+
 setuptools.setup(
     name="federatedscope",
     version="0.0.1",
@@ -20,6 +35,7 @@ setuptools.setup(
         package for package in setuptools.find_packages()
         if package.startswith('federatedscope')
     ],
+    ext_modules=ext_modules,
     install_requires=['torch', 'networkx', 'numpy', 'grpcio>=1.45.0', 'grpcio-tools'],
     setup_requires=[],
     extras_require={'yaml': ['yaml>=5.1']},